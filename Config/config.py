@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 import logging
 
@@ -32,15 +33,27 @@ OCR_DPI = 300
 TABLES_JSONL = OUT_DIR / "tables.jsonl"
 TABLES_SUMMARY_JSONL = OUT_DIR / "tables_summary.jsonl"
 TABLE_EXTRACTION_DPI = 200
+# Each table worker loads its own hi_res layout model; lower this to save RAM/VRAM
+TABLE_MAX_WORKERS = os.cpu_count()
+# Torch threads per table worker; the worker processes already cover the cores
+TABLE_WORKER_THREADS = 1
 
 # ---- METADATA INGESTION ----
 OUTPUT_METADATA = OUT_DIR / "metadata.jsonl"
+METADATA_CACHE = OUT_DIR / "metadata_cache.jsonl"   # (size, mtime) → metadata from previous runs
 INGESTION_LOG = LOG_DIR / "ingestion_errors.log"
 
 # ---- LAYOUT EXTRACTION ----
 LAYOUT_OUTPUT_FILE = OUT_DIR / "layout.jsonl"
 LAYOUT_SUMMARY_FILE = OUT_DIR / "layout_summary.jsonl"
 LAYOUT_ERROR_LOG = LOG_DIR / "layout_extraction_errors.log"
+# Opt-in: send text-only PDFs through the "fast" strategy. It skips table
+# structure inference and reports bboxes in PDF points instead of pixels.
+LAYOUT_ALLOW_FAST_STRATEGY = False
+# Each layout worker loads its own hi_res model; lower this to save RAM/VRAM
+LAYOUT_MAX_WORKERS = os.cpu_count()
+# Torch threads per layout worker; the worker processes already cover the cores
+LAYOUT_WORKER_THREADS = 1
 
 # ===============================
 # LOGGING CONFIGURATION
@@ -62,6 +75,9 @@ DEFAULT_TABLE_DPI = 200
 # Default Visualization Settings
 SHOW_VISUALS = True
 
+# Buffer size for JSONL output files; lines are small, so writes are batched
+WRITE_BUFFER_SIZE = 1 << 20
+
 # ===============================
 # SUMMARY PRINT
 # ===============================
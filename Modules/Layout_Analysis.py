@@ -1,107 +1,215 @@
+import io
 import os
-import json
 import uuid
 import logging
+import multiprocessing
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import orjson
+from PyPDF2 import PdfReader
 from unstructured.partition.pdf import partition_pdf
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
 from ..config import (
     INPUT_DIR,
-    OUTPUT_DIR,
+    OUT_DIR,
     LAYOUT_OUTPUT_FILE,
-    SUMMARY_OUTPUT_FILE,
-    ERROR_LOG_FILE,
+    LAYOUT_SUMMARY_FILE,
+    LAYOUT_ERROR_LOG,
+    LAYOUT_ALLOW_FAST_STRATEGY,
+    LAYOUT_MAX_WORKERS,
+    LAYOUT_WORKER_THREADS,
+    LOG_LEVEL,
+    LOG_FORMAT,
+    WRITE_BUFFER_SIZE,
 )
 
+# Pages with less extractable text than this are treated as scans and sent
+# through the hi_res (Detectron2) strategy.
+MIN_TEXT_CHARS_PER_PAGE = 100
+
 
 # ====================== ENVIRONMENT SETUP ======================
 
 def setup_environment():
-    """Ensure required directories and logging configuration are ready."""
-    for directory in [OUTPUT_DIR]:
+    """Ensure required directories and logging configuration are ready (once per process)."""
+    if getattr(setup_environment, "_done", False):
+        return
+    setup_environment._done = True
+
+    for directory in [OUT_DIR]:
         os.makedirs(directory, exist_ok=True)
 
-    # Reset previous logging handlers (important if rerunning in notebooks)
+    # Replace handlers installed on import of config (or by a previous notebook cell)
     for handler in logging.root.handlers[:]:
         logging.root.removeHandler(handler)
+        handler.close()
 
     logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
+        level=LOG_LEVEL,
+        format=LOG_FORMAT,
         handlers=[
-            logging.FileHandler(ERROR_LOG_FILE),
+            logging.FileHandler(LAYOUT_ERROR_LOG),
             logging.StreamHandler()
         ],
     )
 
 
+def _init_worker():
+    """Set up a layout worker process and cap its Torch intra-op threads."""
+    setup_environment()
+    if torch is not None:
+        torch.set_num_threads(LAYOUT_WORKER_THREADS)
+
+
 # ====================== HELPER FUNCTIONS ======================
 
+# unstructured.io element categories → normalized block types
+_TYPE_MAP = {
+    "Title": "title",
+    "NarrativeText": "paragraph",
+    "UncategorizedText": "paragraph",
+    "ListItem": "paragraph",
+    "Table": "table",
+    "Image": "image",
+    "FigureCaption": "image",
+    "Footer": "footer",
+    "Header": "footer",
+}
+
+
 def map_element_type(element_category: str) -> str:
     """Map unstructured.io element categories to normalized block types."""
-    type_map = {
-        "Title": "title",
-        "NarrativeText": "paragraph",
-        "UncategorizedText": "paragraph",
-        "ListItem": "paragraph",
-        "Table": "table",
-        "Image": "image",
-        "FigureCaption": "image",
-        "Footer": "footer",
-        "Header": "footer",
-    }
-    return type_map.get(element_category, "unknown")
+    return _TYPE_MAP.get(element_category, "unknown")
 
 
 # ====================== CORE EXTRACTION ======================
 
+def element_bboxes(elements) -> list:
+    """
+    Return [x0, y0, x1, y1] (or None) for every element, slicing all coordinates in one NumPy pass.
+    Values are always floats, whichever path builds them.
+    """
+    bboxes = [None] * len(elements)
+    indices, points = [], []
+    for i, el in enumerate(elements):
+        coords = el.metadata.coordinates.points if el.metadata.coordinates else None
+        if coords:
+            indices.append(i)
+            points.append(coords)
+
+    if not indices:
+        return bboxes
+
+    try:
+        corners = np.array(points, dtype=np.float64)[:, [0, 2], :].reshape(-1, 4).tolist()
+    except ValueError:
+        # Non-rectangular regions have a varying number of points
+        corners = [[float(c[0][0]), float(c[0][1]), float(c[2][0]), float(c[2][1])] for c in points]
+
+    for i, bbox in zip(indices, corners):
+        bboxes[i] = bbox
+    return bboxes
+
+
+def iter_blocks(elements, doc_id: str, filename: str, stats_counter: Counter):
+    """
+    Yield normalized layout blocks one at a time, tallying block types into stats_counter.
+    """
+    lookup_type = _TYPE_MAP.get
+    bboxes = element_bboxes(elements)
+
+    for i, el in enumerate(elements):
+        block_type = lookup_type(el.category, "unknown")
+        stats_counter[block_type] += 1
+
+        page_number = el.metadata.page_number or 0
+
+        yield {
+            "doc_id": doc_id,
+            "filename": filename,
+            "page_index": (page_number - 1) if page_number else 0,
+            "block_index": i,
+            "type": block_type,
+            "bbox": bboxes[i],
+            "text": el.text,
+        }
+
+
+def choose_strategy(data: bytes) -> str:
+    """
+    Pick the cheapest partition_pdf strategy for a PDF.
+    "fast" is used only when enabled in config and every page has a text layer and no embedded images.
+    """
+    if not LAYOUT_ALLOW_FAST_STRATEGY:
+        return "hi_res"
+
+    try:
+        reader = PdfReader(io.BytesIO(data))
+        for page in reader.pages:
+            resources = page["/Resources"] if "/Resources" in page else {}
+            xobjects = resources["/XObject"] if "/XObject" in resources else {}
+            if any(xobjects[name].get("/Subtype") == "/Image" for name in xobjects):
+                return "hi_res"
+            if len((page.extract_text() or "").strip()) < MIN_TEXT_CHARS_PER_PAGE:
+                return "hi_res"
+        return "fast"
+    except Exception as e:
+        logging.warning(f"Could not inspect PDF, defaulting to hi_res: {e}")
+        return "hi_res"
+
+
 def process_pdf(pdf_path: str):
     """
     Extracts layout blocks and summary stats from a single PDF.
+    Blocks are returned already serialized as JSONL bytes.
     """
     filename = os.path.basename(pdf_path)
     logging.info(f"Processing: {filename}")
 
     try:
+        with open(pdf_path, "rb") as f:
+            data = f.read()
+
+        strategy = choose_strategy(data)
+        logging.info(f"Using {strategy} strategy for {filename}")
+
         elements = partition_pdf(
-            filename=pdf_path,
-            strategy="hi_res",
+            file=io.BytesIO(data),
+            metadata_filename=filename,
+            strategy=strategy,
             infer_table_structure=True,
             extract_images_in_pdf=False,
         )
 
         doc_id = str(uuid.uuid4())
-        blocks = []
         stats_counter = Counter()
-        max_page_number = 0
-
-        for i, el in enumerate(elements):
-            block_type = map_element_type(el.category)
-            stats_counter[block_type] += 1
-
-            coords = el.metadata.coordinates.points if el.metadata.coordinates else None
-            page_number = el.metadata.page_number or 0
-            max_page_number = max(max_page_number, page_number)
-
-            block_data = {
-                "doc_id": doc_id,
-                "filename": filename,
-                "page_index": (page_number - 1) if page_number else 0,
-                "block_index": i,
-                "type": block_type,
-                "bbox": [coords[0][0], coords[0][1], coords[2][0], coords[2][1]] if coords else None,
-                "text": el.text,
-            }
-            blocks.append(block_data)
+
+        # Serialize as blocks are produced so only one block dict is alive at
+        # a time and only bytes travel back to the parent process. Lines are
+        # staged in one growing buffer instead of a list of per-line bytes.
+        layout_lines = bytearray()
+        extend = layout_lines.extend
+        for block in iter_blocks(elements, doc_id, filename, stats_counter):
+            extend(orjson.dumps(block))
+            extend(b"\n")
+        max_page_number = max((el.metadata.page_number or 0 for el in elements), default=0)
 
         summary = {
             "doc_id": doc_id,
             "filename": filename,
             "n_pages": max_page_number,
+            "strategy": strategy,
             "stats": dict(stats_counter),
         }
 
-        logging.info(f"✅ Completed {filename}: {len(blocks)} blocks, {max_page_number} pages.")
-        return blocks, summary
+        logging.info(f"✅ Completed {filename}: {len(elements)} blocks, {max_page_number} pages.")
+        return layout_lines, summary
 
     except Exception as e:
         logging.error(f"❌ Failed: {filename} — {e}", exc_info=True)
@@ -110,33 +218,67 @@ def process_pdf(pdf_path: str):
 
 # ====================== PIPELINE EXECUTION ======================
 
+def _write_document(f_layout, f_summary, layout_lines: bytes, summary_line: bytes):
+    """Append one document's layout and summary lines, flushing once per document."""
+    f_layout.write(layout_lines)
+    f_summary.write(summary_line)
+    f_layout.flush()
+    f_summary.flush()
+
+
 def extract_layouts():
     """Process all PDFs in input directory and save JSONL outputs."""
     setup_environment()
 
-    # Clean up previous runs
-    for file in [LAYOUT_OUTPUT_FILE, SUMMARY_OUTPUT_FILE]:
-        if os.path.exists(file):
-            os.remove(file)
-
     pdf_files = [f for f in os.listdir(INPUT_DIR) if f.lower().endswith(".pdf")]
 
     if not pdf_files:
+        # Still replace the previous run's outputs so they don't look current
+        for path in (LAYOUT_OUTPUT_FILE, LAYOUT_SUMMARY_FILE):
+            open(path, "wb").close()
         logging.warning("No PDF files found in input directory.")
         return
 
     logging.info(f"Found {len(pdf_files)} PDF(s) to process.")
 
-    for pdf_file in pdf_files:
-        pdf_path = os.path.join(INPUT_DIR, pdf_file)
-        blocks, summary = process_pdf(pdf_path)
+    pdf_paths = [os.path.join(INPUT_DIR, pdf_file) for pdf_file in pdf_files]
+
+    # Layout inference and serialization run in worker processes; results are
+    # written from a single writer thread in this process so the JSONL files
+    # are never appended concurrently and disk writes overlap the next result.
+    # "spawn" keeps Detectron2/Torch (and CUDA) safe in the workers. Because
+    # each worker owns a whole PDF, one worker's page rasterization (poppler,
+    # CPU) overlaps another's model inference, keeping both devices busy.
+    # Both outputs are opened once and truncated, replacing any previous run.
+    # Spawned workers inherit this before OpenMP initializes in their imports
+    os.environ.setdefault("OMP_NUM_THREADS", str(LAYOUT_WORKER_THREADS))
+
+    with ProcessPoolExecutor(
+        max_workers=LAYOUT_MAX_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+    ) as executor, \
+         open(LAYOUT_OUTPUT_FILE, "wb", buffering=WRITE_BUFFER_SIZE) as f_layout, \
+         open(LAYOUT_SUMMARY_FILE, "wb", buffering=WRITE_BUFFER_SIZE) as f_summary, \
+         ThreadPoolExecutor(max_workers=1) as writer:
+
+        results = executor.map(process_pdf, pdf_paths, chunksize=1)
+        pending_write = None
+
+        for layout_lines, summary in results:
+            if layout_lines and summary:
+                # At most one document is queued behind the writer
+                if pending_write is not None:
+                    pending_write.result()
+                pending_write = writer.submit(
+                    _write_document, f_layout, f_summary, layout_lines, orjson.dumps(summary) + b"\n"
+                )
+
+        if pending_write is not None:
+            pending_write.result()
 
-        if blocks and summary:
-            with open(LAYOUT_OUTPUT_FILE, "a", encoding="utf-8") as f_layout:
-                for block in blocks:
-                    f_layout.write(json.dumps(block, ensure_ascii=False) + "\n")
+    logging.info(f"✅ Layout extraction complete!\n→ Layouts: {LAYOUT_OUTPUT_FILE}\n→ Summary: {LAYOUT_SUMMARY_FILE}")
 
-            with open(SUMMARY_OUTPUT_FILE, "a", encoding="utf-8") as f_summary:
-                f_summary.write(json.dumps(summary, ensure_ascii=False) + "\n")
 
-    logging.info(f"✅ Layout extraction complete!\n→ Layouts: {LAYOUT_OUTPUT_FILE}\n→ Summary: {SUMMARY_OUTPUT_FILE}")
+if __name__ == "__main__":
+    extract_layouts()
@@ -1,25 +1,44 @@
+import io
 import os
-import json
 import hashlib
 import logging
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+import orjson
 from PyPDF2 import PdfReader
-from ..config import ROOT_DIR, OUTPUT_METADATA, ERROR_LOG
+from ..config import ROOT_DIR, OUTPUT_METADATA, METADATA_CACHE, ERROR_LOG, WRITE_BUFFER_SIZE
 
+# Hashing and page counting are disk-bound; a handful of threads overlaps the
+# reads without flooding network storage with outstanding requests.
+MAX_WORKERS = 16
 
-def compute_hash(file_path: Path) -> str:
-    """Compute SHA1 hash of a file for uniqueness checking."""
-    sha1 = hashlib.sha1()
-    with open(file_path, "rb") as f:
-        while chunk := f.read(8192):
-            sha1.update(chunk)
-    return sha1.hexdigest()
 
+def _advise_sequential(f) -> None:
+    """Hint the kernel to read ahead aggressively on a file read start to end."""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
 
-def process_pdf(file_path: Path):
+
+def read_pdf(file_path: Path) -> bytes:
+    """Read a PDF into memory once so hashing and parsing share the bytes."""
+    with open(file_path, "rb", buffering=0) as f:
+        _advise_sequential(f)
+        return f.read()
+
+
+def compute_hash(data: bytes) -> str:
+    """Compute SHA1 hash of a file's contents for uniqueness checking."""
+    return hashlib.sha1(data).hexdigest()
+
+
+def process_pdf(file_path: Path, data: bytes):
     """Validate and extract metadata (page count) from a PDF."""
     try:
-        reader = PdfReader(file_path)
+        reader = PdfReader(io.BytesIO(data))
         num_pages = len(reader.pages)
         return num_pages
     except Exception as e:
@@ -27,29 +46,126 @@ def process_pdf(file_path: Path):
         return None
 
 
+def _is_valid_cache_entry(entry) -> bool:
+    """Check that a cache line has every field _ingest_one reads, with the right types."""
+    if not isinstance(entry, dict) or not isinstance(entry.get("mtime_ns"), int):
+        return False
+    metadata = entry.get("metadata")
+    return (
+        isinstance(metadata, dict)
+        and isinstance(metadata.get("filename"), str)
+        and isinstance(metadata.get("filesize"), int)
+    )
+
+
+def load_cache(cache_path: Path) -> dict:
+    """Load the metadata cache from a previous run, keyed by relative filename."""
+    cache = {}
+    if not os.path.exists(cache_path):
+        return cache
+
+    with open(cache_path, "rb") as f:
+        for line in f:
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            # Truncated, hand-edited or older-schema lines are ignored
+            if _is_valid_cache_entry(entry):
+                cache[entry["metadata"]["filename"]] = entry
+    return cache
+
+
+def save_cache(cache_path: Path, entries: list):
+    """Replace the metadata cache with the entries from the current run."""
+    tmp_path = Path(f"{cache_path}.tmp")
+    with open(tmp_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        for entry in entries:
+            f.write(orjson.dumps(entry) + b"\n")
+    os.replace(tmp_path, cache_path)
+
+
+def iter_pdfs(root_dir):
+    """
+    Yield (relative_path, DirEntry) for every PDF under root_dir, walking iteratively with os.scandir.
+    Relative paths are built during the walk rather than recomputed per file.
+    """
+    stack = [(root_dir, "")]
+    while stack:
+        directory, rel_dir = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, rel_path))
+                    elif entry.name.lower().endswith(".pdf"):
+                        yield rel_path, entry
+        except OSError as e:
+            logging.error(f"Could not scan directory {directory}: {e}")
+
+
+def _ingest_one(work_item: tuple, cache: dict):
+    """
+    Build the cache entry ({"mtime_ns", "metadata"}) for a single PDF, or None if it is invalid.
+    Files whose size and mtime match the cache are not read again.
+    """
+    rel_path, dir_entry = work_item
+    file_path = dir_entry.path
+
+    try:
+        stat = dir_entry.stat()
+    except OSError as e:
+        logging.error(f"Failed to process: {file_path}: {e}")
+        return None
+
+    cached = cache.get(rel_path)
+    if (
+        cached is not None
+        and cached["mtime_ns"] == stat.st_mtime_ns
+        and cached["metadata"]["filesize"] == stat.st_size
+    ):
+        return cached
+
+    try:
+        data = read_pdf(file_path)
+    except OSError as e:
+        logging.error(f"Failed to process: {file_path}: {e}")
+        return None
+
+    n_pages = process_pdf(file_path, data)
+
+    if n_pages is None:
+        logging.error(f"Failed to process: {file_path}")
+        return None
+
+    return {
+        "mtime_ns": stat.st_mtime_ns,
+        "metadata": {
+            "filename": rel_path,
+            "n_pages": n_pages,
+            "filesize": len(data),
+            "hash": compute_hash(data)
+        },
+    }
+
+
 def ingest_metadata():
     """Walk through input directory, extract metadata, and save JSONL output."""
     logging.basicConfig(filename=ERROR_LOG, level=logging.ERROR, format="%(asctime)s - %(message)s")
 
-    with open(OUTPUT_METADATA, "w", encoding="utf-8") as meta_file:
-        for root, _, files in os.walk(ROOT_DIR):
-            for filename in files:
-                if not filename.lower().endswith(".pdf"):
-                    continue
-
-                file_path = Path(root) / filename
-                filesize = os.path.getsize(file_path)
-                n_pages = process_pdf(file_path)
-
-                if n_pages is not None:
-                    metadata = {
-                        "filename": str(Path(file_path).relative_to(ROOT_DIR)),
-                        "n_pages": n_pages,
-                        "filesize": filesize,
-                        "hash": compute_hash(file_path)
-                    }
-                    meta_file.write(json.dumps(metadata, ensure_ascii=False) + "\n")
-                else:
-                    logging.error(f"Failed to process: {file_path}")
+    work_items = list(iter_pdfs(ROOT_DIR))
+    cache = load_cache(METADATA_CACHE)
+    entries = []
+
+    with open(OUTPUT_METADATA, "wb", buffering=WRITE_BUFFER_SIZE) as meta_file, \
+         ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+
+        for entry in executor.map(_ingest_one, work_items, repeat(cache)):
+            if entry is not None:
+                meta_file.write(orjson.dumps(entry["metadata"]) + b"\n")
+                entries.append(entry)
+
+    save_cache(METADATA_CACHE, entries)
 
     print(f"✅ Metadata ingestion complete!\n→ Output: {OUTPUT_METADATA}\n→ Errors: {ERROR_LOG}")
@@ -1,13 +1,28 @@
 import os
-import json
 import uuid
+import asyncio
 import logging
+import multiprocessing
+import subprocess
+import tempfile
+from collections import defaultdict
 import cv2
-import pytesseract
+import aiopytesseract
 import numpy as np
+import orjson
 from pdf2image import convert_from_path
 from unstructured.partition.pdf import partition_pdf
 
+try:
+    from tesserocr import PyTessBaseAPI, PSM
+except ImportError:
+    PyTessBaseAPI = None
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
 from config import (
     INPUT_DIR,
     OUTPUT_DIR,
@@ -16,12 +31,28 @@ from config import (
     TABLES_JSONL,
     SUMMARY_JSONL,
     DPI,
+    TABLE_MAX_WORKERS,
+    TABLE_WORKER_THREADS,
+    WRITE_BUFFER_SIZE,
 )
 
 # ==================== LOGGING ====================
 logging.basicConfig(level=getattr(logging, LOG_LEVEL.upper()),
                     format="%(asctime)s - %(levelname)s - %(message)s")
 
+# Fallback per-cell OCR runs tesseract subprocesses concurrently; each pool
+# worker only gets its share of the cores
+OCR_CONCURRENCY = max(1, os.cpu_count() // TABLE_MAX_WORKERS)
+
+# Cells taller than this are downscaled by half before OCR
+CELL_DOWNSCALE_MIN_HEIGHT = 60
+
+# Line-detection kernels are read-only, so every table shares one copy
+_HORIZ_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (40, 1))
+_VERT_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (1, 40))
+
+_tess_api = None
+
 
 # ==================== PDF REPAIR ====================
 def repair_pdf(input_path: str, output_path: str) -> str | None:
@@ -67,102 +98,238 @@ def extract_layout(pdf_path: str):
         return []
 
 
+# ==================== CELL OCR ====================
+async def _ocr_cell(img_bytes: bytes, sem: asyncio.Semaphore) -> str:
+    """
+    OCR a single PNG-encoded cell, bounded by the shared semaphore.
+    """
+    async with sem:
+        text = await aiopytesseract.image_to_string(img_bytes, psm=6)
+    return text.strip()
+
+
+async def _ocr_cells(cell_images: list) -> list:
+    """
+    OCR all cell images concurrently, preserving input order.
+    """
+    sem = asyncio.Semaphore(OCR_CONCURRENCY)
+    return await asyncio.gather(*[_ocr_cell(img, sem) for img in cell_images])
+
+
+def _ocr_cells_batch(cell_crops: list) -> list:
+    """
+    OCR all cell crops with a single tesseract process reading an image-list file.
+    Tesseract terminates each image's text with a form feed, which maps output back to cells.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_paths = []
+        for i, crop in enumerate(cell_crops):
+            image_path = os.path.join(tmp_dir, f"cell_{i}.png")
+            cv2.imwrite(image_path, crop)
+            image_paths.append(image_path)
+
+        list_path = os.path.join(tmp_dir, "images.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(image_paths) + "\n")
+
+        result = subprocess.run(
+            ["tesseract", list_path, "stdout", "--psm", "6", "-c", "page_separator=\f"],
+            capture_output=True,
+            check=True,
+        )
+
+    texts = result.stdout.decode("utf-8", errors="replace").split("\f")
+    if len(texts) < len(cell_crops):
+        raise ValueError(f"tesseract returned {len(texts)} pages for {len(cell_crops)} cells")
+    return [text.strip() for text in texts[:len(cell_crops)]]
+
+
+def _ocr_cells_in_process(cell_crops: list) -> list:
+    """
+    OCR cell crops through one persistent tesserocr API, passing pixels from memory.
+    The engine is initialized once per process instead of once per cell.
+    """
+    global _tess_api
+    if _tess_api is None:
+        _tess_api = PyTessBaseAPI(psm=PSM.SINGLE_BLOCK)
+
+    texts = []
+    for crop in cell_crops:
+        crop = np.ascontiguousarray(crop)
+        height, width = crop.shape
+        _tess_api.SetImageBytes(crop.tobytes(), width, height, 1, width)
+        texts.append(_tess_api.GetUTF8Text().strip())
+    return texts
+
+
+def _prepare_cell(cell_crop: np.ndarray) -> np.ndarray:
+    """
+    Binarize a cell with Otsu and halve tall cells; tesseract time scales with pixel area.
+    """
+    _, bin_cell = cv2.threshold(cell_crop, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    h, w = bin_cell.shape[:2]
+    if h > CELL_DOWNSCALE_MIN_HEIGHT:
+        # Explicit size so 1px-wide slivers do not round down to zero width
+        bin_cell = cv2.resize(bin_cell, (max(1, w // 2), max(1, h // 2)), interpolation=cv2.INTER_AREA)
+    return bin_cell
+
+
+def ocr_cells(cell_crops: list) -> list:
+    """
+    OCR prepared cell crops, returning their text in input order.
+    Uses in-process tesserocr when installed, otherwise one batched tesseract call,
+    falling back to concurrent per-cell OCR if the batch call fails.
+    """
+    try:
+        if PyTessBaseAPI is not None:
+            texts = _ocr_cells_in_process(cell_crops)
+        else:
+            texts = _ocr_cells_batch(cell_crops)
+    except (OSError, RuntimeError, subprocess.CalledProcessError, ValueError) as e:
+        logging.warning(f"Cell OCR failed ({e}), falling back to per-cell OCR")
+        cell_images = [cv2.imencode(".png", crop)[1].tobytes() for crop in cell_crops]
+        texts = asyncio.run(_ocr_cells(cell_images))
+
+    return texts
+
+
+# ==================== GRID DETECTION ====================
+def detect_table_grid(thresh: np.ndarray) -> np.ndarray:
+    """
+    Keep the horizontal and vertical lines of a binary table mask and merge them into a grid.
+    """
+    horiz = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, _HORIZ_KERNEL, iterations=2)
+    vert = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, _VERT_KERNEL, iterations=2)
+    # Masks are binary and only their non-zero support matters downstream
+    return cv2.bitwise_or(horiz, vert)
+
+
+def find_cell_boxes(table_grid: np.ndarray, min_area: int = 200) -> np.ndarray:
+    """
+    Return (x, y, w, h) boxes of the cells enclosed by a table grid as an (N, 4) int32 array.
+    Cells are the connected regions between grid lines; regions touching the crop edge lie outside the grid.
+    """
+    _, _, stats, _ = cv2.connectedComponentsWithStats(cv2.bitwise_not(table_grid), connectivity=4)
+    stats = stats[1:]  # label 0 is the grid lines themselves
+
+    left, top = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+    width, height = stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT]
+    grid_h, grid_w = table_grid.shape
+    keep = (
+        (stats[:, cv2.CC_STAT_AREA] > min_area)
+        & (left > 0) & (top > 0)
+        & (left + width < grid_w) & (top + height < grid_h)
+    )
+    return stats[keep][:, [cv2.CC_STAT_LEFT, cv2.CC_STAT_TOP, cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT]]
+
+
 # ==================== TABLE EXTRACTION ====================
 def save_to_jsonl_with_strong_table_extraction(pdf_path: str, elements: list, doc_id: str):
     """
-    Detect tables in PDF pages, extract cells via OCR, and save to JSONL.
+    Detect tables in PDF pages, extract cells via OCR, and serialize them to JSONL.
+    Returns (tables_jsonl, summary_jsonl) for the caller to write.
     """
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
     pdf_name = os.path.basename(pdf_path)
     pages_with_tables, table_records = [], []
+    table_lines = []
+
+    # Bucket table elements by page once instead of rescanning per page
+    tables_by_page = defaultdict(list)
+    for el in elements:
+        if getattr(el, "category", "").lower() == "table":
+            page_number = getattr(el.metadata, "page_number", None)
+            if page_number:
+                tables_by_page[page_number].append(el)
+
+    # Only pages that hold tables are rasterized, each into a scratch folder as
+    # uncompressed PPM rather than held in memory as PIL images
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for page_number in sorted(tables_by_page):
+            page_index = page_number - 1
+            page_tables = tables_by_page[page_number]
+            try:
+                page_paths = convert_from_path(
+                    pdf_path, dpi=DPI, grayscale=True, fmt="ppm",
+                    first_page=page_number, last_page=page_number,
+                    output_folder=tmp_dir, paths_only=True
+                )
+                if not page_paths:
+                    continue
 
-    try:
-        pages = convert_from_path(pdf_path, dpi=DPI)
-    except Exception as e:
-        logging.error(f"Could not read PDF pages for {pdf_name}: {e}")
-        return
-
-    for page_index, page_img in enumerate(pages):
-        try:
-            page_np = np.array(page_img)
-            page_gray = cv2.cvtColor(page_np, cv2.COLOR_RGB2GRAY)
-
-            # Find tables for this page
-            page_tables = [
-                el for el in elements
-                if getattr(el, "category", "").lower() == "table"
-                and getattr(el.metadata, "page_number", None) == page_index + 1
-            ]
-
-            for table_index, table in enumerate(page_tables):
-                coords = getattr(table.metadata, "coordinates", None)
-                if not coords or not coords.points:
+                page_gray = cv2.imread(page_paths[0], cv2.IMREAD_GRAYSCALE)
+                os.remove(page_paths[0])
+
+                # Detect the cells of every table first, so the whole page is
+                # OCR'd in a single batch
+                detected_tables, page_crops = [], []
+
+                for table_index, table in enumerate(page_tables):
+                    coords = getattr(table.metadata, "coordinates", None)
+                    if not coords or not coords.points:
+                        continue
+
+                    x0, y0 = map(int, coords.points[0])
+                    x1, y1 = map(int, coords.points[2])
+                    table_crop = page_gray[y0:y1, x0:x1]
+
+                    # Detect grid lines using morphology
+                    thresh = cv2.adaptiveThreshold(
+                        table_crop, 255,
+                        cv2.ADAPTIVE_THRESH_MEAN_C,
+                        cv2.THRESH_BINARY_INV, 15, 10
+                    )
+                    table_grid = detect_table_grid(thresh)
+
+                    boxes = find_cell_boxes(table_grid)
+                    if len(boxes) == 0:
+                        # Borderless tables have no grid; skip them without
+                        # dropping the other tables on the page
+                        logging.warning(f"No cells found in table {table_index} on page {page_index} of {pdf_name}")
+                        continue
+
+                    # Group cells into rows: sort by (y, x), start a new row wherever
+                    # consecutive boxes are 20px or more apart vertically, then order
+                    # each row by x with one more stable sort instead of one per row
+                    boxes = boxes[np.lexsort((boxes[:, 0], boxes[:, 1]))]
+                    row_ids = np.concatenate(([0], np.cumsum(np.diff(boxes[:, 1]) >= 20)))
+                    boxes = boxes[np.lexsort((boxes[:, 0], row_ids))]
+                    breaks = np.flatnonzero(np.diff(row_ids)) + 1
+                    rows = np.split(boxes, breaks)
+
+                    page_crops.extend(
+                        _prepare_cell(table_crop[cy:cy+ch, cx:cx+cw])
+                        for row in rows for (cx, cy, cw, ch) in row
+                    )
+                    detected_tables.append((table_index, [x0, y0, x1, y1], rows))
+
+                if not detected_tables:
                     continue
 
-                x0, y0 = map(int, coords.points[0])
-                x1, y1 = map(int, coords.points[2])
-                table_crop = page_gray[y0:y1, x0:x1]
+                texts = iter(ocr_cells(page_crops))
 
-                # Detect grid lines using morphology
-                thresh = cv2.adaptiveThreshold(
-                    table_crop, 255,
-                    cv2.ADAPTIVE_THRESH_MEAN_C,
-                    cv2.THRESH_BINARY_INV, 15, 10
-                )
-                horiz_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (40, 1))
-                vert_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, 40))
-                horiz = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, horiz_kernel, iterations=2)
-                vert = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, vert_kernel, iterations=2)
-                table_grid = cv2.addWeighted(horiz, 0.5, vert, 0.5, 0.0)
-
-                contours, _ = cv2.findContours(table_grid, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-                cell_boxes = [cv2.boundingRect(c) for c in contours if cv2.contourArea(c) > 200]
-                if not cell_boxes:
-                    raise ValueError("No cells found in detected table")
-
-                # Group cells into rows
-                cell_boxes = sorted(cell_boxes, key=lambda b: (b[1], b[0]))
-                rows, current_row = [], [cell_boxes[0]]
-                for b in cell_boxes[1:]:
-                    if abs(b[1] - current_row[-1][1]) < 20:
-                        current_row.append(b)
-                    else:
-                        rows.append(sorted(current_row, key=lambda x: x[0]))
-                        current_row = [b]
-                rows.append(sorted(current_row, key=lambda x: x[0]))
-
-                n_rows, n_cols = len(rows), max(len(r) for r in rows)
-                cells_text = []
-                for row in rows:
-                    row_text = []
-                    for (cx, cy, cw, ch) in row:
-                        cell_crop = table_crop[cy:cy+ch, cx:cx+cw]
-                        text = pytesseract.image_to_string(cell_crop, config="--psm 6").strip()
-                        row_text.append(text)
-                    cells_text.append(row_text)
-
-                record = {
-                    "doc_id": doc_id,
-                    "filename": pdf_name,
-                    "page_index": page_index,
-                    "table_index": table_index,
-                    "bbox": [x0, y0, x1, y1],
-                    "n_rows": n_rows,
-                    "n_cols": n_cols,
-                    "cells": cells_text
-                }
-
-                # Write individual table record
-                with open(TABLES_JSONL, "a", encoding="utf-8") as f:
-                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
-
-                table_records.append(record)
-                pages_with_tables.append(page_index)
-
-        except Exception as e:
-            logging.error(f"Table extraction failed on page {page_index} of {pdf_name}: {e}")
-
-    # Write summary record
+                for table_index, bbox, rows in detected_tables:
+                    n_rows, n_cols = len(rows), max(len(r) for r in rows)
+                    cells_text = [[next(texts) for _ in row] for row in rows]
+
+                    record = {
+                        "doc_id": doc_id,
+                        "filename": pdf_name,
+                        "page_index": page_index,
+                        "table_index": table_index,
+                        "bbox": bbox,
+                        "n_rows": n_rows,
+                        "n_cols": n_cols,
+                        "cells": cells_text
+                    }
+
+                    table_lines.append(orjson.dumps(record) + b"\n")
+                    table_records.append(record)
+                    pages_with_tables.append(page_index)
+
+            except Exception as e:
+                logging.error(f"Table extraction failed on page {page_index} of {pdf_name}: {e}")
+
+    # Summary record
     summary_record = {
         "doc_id": doc_id,
         "filename": pdf_name,
@@ -170,10 +337,27 @@ def save_to_jsonl_with_strong_table_extraction(pdf_path: str, elements: list, do
         "pages_with_tables": sorted(list(set(pages_with_tables)))
     }
 
-    with open(SUMMARY_JSONL, "a", encoding="utf-8") as f:
-        f.write(json.dumps(summary_record, ensure_ascii=False) + "\n")
+    logging.info(f"✅ Extracted {len(table_records)} tables for {pdf_name}")
+    return b"".join(table_lines), orjson.dumps(summary_record) + b"\n"
 
-    logging.info(f"✅ Saved {len(table_records)} tables for {pdf_name}")
+
+def _init_worker():
+    """
+    Cap Torch intra-op threads in a table worker process.
+    """
+    if torch is not None:
+        torch.set_num_threads(TABLE_WORKER_THREADS)
+
+
+def process_document(pdf_path: str):
+    """
+    Worker entry point: extract layout and tables for one PDF, returning its JSONL chunks.
+    """
+    doc_id = str(uuid.uuid4())
+    logging.info(f"Processing {os.path.basename(pdf_path)} ...")
+
+    elements = extract_layout(pdf_path)
+    return save_to_jsonl_with_strong_table_extraction(pdf_path, elements, doc_id)
 
 
 # ==================== MAIN PIPELINE ====================
@@ -187,13 +371,26 @@ def run_pipeline(input_dir: str = INPUT_DIR):
         logging.warning(f"No PDF files found in {input_dir}")
         return
 
-    for pdf_file in pdf_files:
-        pdf_path = os.path.join(input_dir, pdf_file)
-        doc_id = str(uuid.uuid4())
-        logging.info(f"Processing {pdf_file} ...")
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    pdf_paths = [os.path.join(input_dir, pdf_file) for pdf_file in pdf_files]
+
+    # Documents are processed in parallel; only this process writes the JSONL
+    # files. "spawn" keeps the hi_res layout model (Torch) safe in workers.
+    # Spawned workers (and their tesseract children) inherit this before
+    # OpenMP initializes.
+    os.environ.setdefault("OMP_NUM_THREADS", str(TABLE_WORKER_THREADS))
+
+    with open(TABLES_JSONL, "ab", buffering=WRITE_BUFFER_SIZE) as tables_f, \
+         open(SUMMARY_JSONL, "ab", buffering=WRITE_BUFFER_SIZE) as summary_f, \
+         multiprocessing.get_context("spawn").Pool(TABLE_MAX_WORKERS, initializer=_init_worker) as pool:
+
+        for result in pool.imap_unordered(process_document, pdf_paths):
+            if result is None:
+                continue
 
-        elements = extract_layout(pdf_path)
-        save_to_jsonl_with_strong_table_extraction(pdf_path, elements, doc_id)
+            tables_jsonl, summary_jsonl = result
+            tables_f.write(tables_jsonl)
+            summary_f.write(summary_jsonl)
 
     logging.info("🎯 Pipeline completed successfully!")
 
@@ -1,88 +1,139 @@
 import os
-import json
 import uuid
 import logging
+import multiprocessing
 
+import orjson
 import pytesseract
 from pdf2image import convert_from_path
 
 try:
-    from PyPDF2 import PdfReader
+    import pypdfium2 as pdfium
 except ImportError:
-    PdfReader = None
+    pdfium = None
 
-from config import DATA_DIR, BLOCKS_FILE, DOCS_FILE, ERROR_LOG, OCR_DPI
+from config import DATA_DIR, BLOCKS_FILE, DOCS_FILE, ERROR_LOG, OCR_DPI, WRITE_BUFFER_SIZE
 
 # =============== LOGGING SETUP =================
 logging.basicConfig(filename=ERROR_LOG, level=logging.ERROR)
 
+# A digital page needs OCR unless its first OCR_PROBE_CHARS characters hold
+# at least OCR_MIN_ALNUM letters/digits (catches empty and garbage text layers)
+OCR_PROBE_CHARS = 200
+OCR_MIN_ALNUM = 20
 
-def extract_text_digital(pdf_path: str, page_num: int) -> str:
+# Max pages rasterized per pdftoppm call; bounds memory at OCR_DPI
+OCR_BATCH_PAGES = 16
+
+
+def needs_ocr(text: str) -> bool:
     """
-    Try extracting text using PyPDF2 for a specific page.
+    Cheap check whether a page's digital text is too thin to trust, inspecting only a bounded prefix.
     """
-    if PdfReader is None:
-        logging.error("PyPDF2 not installed.")
-        return ""
+    if len(text) < 10:
+        return True
+    return sum(1 for c in text[:OCR_PROBE_CHARS] if c.isalnum()) < OCR_MIN_ALNUM
+
 
+def extract_text_digital(pdf, page_num: int, pdf_path: str) -> str:
+    """
+    Try extracting text using pypdfium2 for a specific page of an already opened document.
+    """
     try:
-        reader = PdfReader(pdf_path)
-        page = reader.pages[page_num]
-        text = page.extract_text() or ""
-        return text.strip()
+        page = pdf[page_num]
+        textpage = page.get_textpage()
+        text = textpage.get_text_range() or ""
+        textpage.close()
+        page.close()
+        # pdfium marks soft hyphens at line breaks with U+FFFE
+        return text.replace("\r\n", "\n").replace("\ufffe", "").strip()
     except Exception as e:
         logging.error(f"Digital extraction failed: {pdf_path}, page {page_num} - {e}")
         return ""
 
 
-def extract_text_ocr(pdf_path: str, page_num: int) -> str:
+def _page_runs(page_nums: list):
+    """
+    Split sorted page numbers into (first, last) runs of consecutive pages, at most OCR_BATCH_PAGES long.
+    """
+    first = last = None
+    for page_num in page_nums:
+        if first is not None and page_num == last + 1 and page_num - first < OCR_BATCH_PAGES:
+            last = page_num
+            continue
+        if first is not None:
+            yield first, last
+        first = last = page_num
+    if first is not None:
+        yield first, last
+
+
+def extract_text_ocr(pdf_path: str, page_nums: list) -> dict:
     """
     Fallback OCR text extraction using pytesseract + pdf2image.
+    Each run of consecutive pages is rasterized with a single convert_from_path call.
+    Returns {page_num: text}; pages that fail are omitted.
     """
-    try:
-        images = convert_from_path(
-            pdf_path, 
-            first_page=page_num + 1,
-            last_page=page_num + 1,
-            dpi=OCR_DPI
-        )
-        text = pytesseract.image_to_string(images[0])
-        return text.strip()
-    except Exception as e:
-        logging.error(f"OCR failed: {pdf_path}, page {page_num} - {e}")
-        return ""
-
-
-def process_pdf(pdf_path: str, blocks_writer, docs_writer):
+    texts = {}
+    for first, last in _page_runs(page_nums):
+        try:
+            images = convert_from_path(
+                pdf_path,
+                first_page=first + 1,
+                last_page=last + 1,
+                dpi=OCR_DPI
+            )
+        except Exception as e:
+            logging.error(f"OCR failed: {pdf_path}, pages {first}-{last} - {e}")
+            continue
+
+        for page_num, image in zip(range(first, last + 1), images):
+            try:
+                texts[page_num] = pytesseract.image_to_string(image).strip()
+            except Exception as e:
+                logging.error(f"OCR failed: {pdf_path}, page {page_num} - {e}")
+    return texts
+
+
+def process_pdf(pdf_path: str):
     """
     Process a single PDF file and extract text page-by-page.
+    Returns (blocks_jsonl, docs_jsonl) for the caller to write, or None on failure.
     """
+    print(f"Processing {pdf_path} ...")
     filename = os.path.basename(pdf_path)
     doc_id = uuid.uuid4().hex
 
-    if PdfReader is None:
-        logging.error("PyPDF2 not installed, cannot process digital text.")
-        return
+    if pdfium is None:
+        logging.error("pypdfium2 not installed, cannot process digital text.")
+        return None
 
     # Read number of pages
     try:
-        reader = PdfReader(pdf_path)
-        n_pages = len(reader.pages)
+        pdf = pdfium.PdfDocument(pdf_path)
+        n_pages = len(pdf)
     except Exception as e:
         logging.error(f"Could not read PDF {pdf_path} - {e}")
-        return
+        return None
 
     aggregated_text = []
+    block_lines = []
     total_words = 0
     pages_by_source = {"digital": 0, "ocr": 0, "error": 0}
 
-    for i in range(n_pages):
-        text = extract_text_digital(pdf_path, i)
+    # Digital pass first, so every page needing OCR is rasterized in batches
+    digital_texts = [extract_text_digital(pdf, i, pdf_path) for i in range(n_pages)]
+    pdf.close()
+    ocr_pages = [i for i, text in enumerate(digital_texts) if needs_ocr(text)]
+    ocr_texts = extract_text_ocr(pdf_path, ocr_pages) if ocr_pages else {}
+    ocr_needed = set(ocr_pages)
 
-        if not text or len(text.split()) < 3:  # Too short → fallback to OCR
-            text = extract_text_ocr(pdf_path, i)
+    for i in range(n_pages):
+        if i in ocr_needed:
+            text = ocr_texts.get(i, "")
             source = "ocr" if text else "error"
         else:
+            text = digital_texts[i]
             source = "digital"
 
         if not text:
@@ -94,16 +145,16 @@ def process_pdf(pdf_path: str, blocks_writer, docs_writer):
             aggregated_text.append(text)
             pages_by_source[source] += 1
 
-            blocks_writer.write(json.dumps({
+            block_lines.append(orjson.dumps({
                 "doc_id": doc_id,
                 "filename": filename,
                 "page_index": i,
                 "source": source,
                 "text": text,
                 "n_words": word_count
-            }, ensure_ascii=False) + "\n")
+            }) + b"\n")
 
-    docs_writer.write(json.dumps({
+    doc_line = orjson.dumps({
         "doc_id": doc_id,
         "filename": filename,
         "n_pages": n_pages,
@@ -112,22 +163,37 @@ def process_pdf(pdf_path: str, blocks_writer, docs_writer):
             "total_words": total_words,
             "pages_by_source": pages_by_source
         }
-    }, ensure_ascii=False) + "\n")
+    }) + b"\n"
+
+    return b"".join(block_lines), doc_line
 
 
 def run_extraction(input_dir: str = DATA_DIR):
     """
     Run extraction for all PDFs in the input folder.
     """
-    with open(BLOCKS_FILE, "w", encoding="utf-8") as blocks_writer, \
-         open(DOCS_FILE, "w", encoding="utf-8") as docs_writer:
-
-        for root, _, files in os.walk(input_dir):
-            for f in files:
-                if f.lower().endswith(".pdf"):
-                    pdf_path = os.path.join(root, f)
-                    print(f"Processing {pdf_path} ...")
-                    process_pdf(pdf_path, blocks_writer, docs_writer)
+    pdf_paths = [
+        os.path.join(root, f)
+        for root, _, files in os.walk(input_dir)
+        for f in files
+        if f.lower().endswith(".pdf")
+    ]
+
+    # PDFs are extracted in worker processes; only this process writes output.
+    # One worker per core already, so each tesseract call stays single-threaded.
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+    with open(BLOCKS_FILE, "wb", buffering=WRITE_BUFFER_SIZE) as blocks_writer, \
+         open(DOCS_FILE, "wb", buffering=WRITE_BUFFER_SIZE) as docs_writer, \
+         multiprocessing.Pool(os.cpu_count()) as pool:
+
+        for result in pool.imap_unordered(process_pdf, pdf_paths):
+            if result is None:
+                continue
+
+            blocks_jsonl, docs_jsonl = result
+            blocks_writer.write(blocks_jsonl)
+            docs_writer.write(docs_jsonl)
 
     print("✅ Extraction complete!")
     print(f"Blocks → {BLOCKS_FILE}")